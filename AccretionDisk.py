@@ -95,6 +95,24 @@ class AccretionDisk(object):
         rho = rho.reshape((num_points + 1, num_points + 1, num_points + 1))
         return rho
 
+    def get_density_map_bytes(self, num_points=1000, z_plane=None):
+        """
+        Estimates the memory get_density_map needs in this process, at its peak during the call to
+        get_hydro_state_at_point, in float64 arrays over all sampled points:
+
+            6 for x, y, z, vx, vy, vz (wrapping them in units does not copy them)
+            6 for their conversion to the units of the code
+            6 for packing them into the message to the workers
+            5 for the rho, rhovx, rhovy, rhovz, rhoe of the reply
+            5 for their conversion back to SI units
+
+        The copies in the Gadget2 workers, about 11 arrays spread over the workers, are not included
+
+        :return: Estimated bytes
+        """
+        number_of_points = (num_points + 1) ** (3 if z_plane is None else 2)
+        return (6 + 6 + 6 + 5 + 5) * 8 * number_of_points
+
     def get_total_energy(self):
         """
         Gets the total energy of the hydro system
@@ -1,7 +1,13 @@
 from __future__ import print_function
+import os
+import shutil
+import tempfile
+from timeit import default_timer
 from AccretionDisk import AccretionDisk
 from SuperMassiveBlackHole import SuperMassiveBlackHole
 from BinaryBlackHole import BinaryBlackHole
+from CachedDiskField import CachedDiskField
+from DynamicalFriction import DynamicalFriction
 from amuse.couple.bridge import Bridge
 from amuse.community.huayno.interface import Huayno
 import numpy
@@ -13,6 +19,42 @@ def grouped(iterable, n):
     return izip(*[iter(iterable)] * n)
 
 
+def get_peak_memory_bytes():
+    """
+    Peak resident memory of this process and all the processes it started, such as the MPI workers of the codes.
+    Reads /proc, so only works on Linux, elsewhere it returns 0
+    :return: Sum of the peak resident memory, in bytes
+    """
+    if not os.path.isdir('/proc'):
+        return 0
+
+    children = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'stat')) as stat_file:
+                parent = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(pid))
+
+    peak_memory = 0
+    processes = [os.getpid()]
+    while processes:
+        pid = processes.pop()
+        processes.extend(children.get(pid, []))
+        try:
+            with open(os.path.join('/proc', str(pid), 'status')) as status_file:
+                for line in status_file:
+                    if line.startswith('VmHWM:'):
+                        peak_memory += int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            continue
+
+    return peak_memory
+
+
 class SuperMassiveBlackHolePotential(object):
     def __init__(self, R, M):
         self.radius = R
@@ -43,7 +85,10 @@ class BinaryBlackHolesWithAGN(object):
                  blackhole_masses=30 | units.MSun, timestep=0.1 | units.Myr, gravity_timestep=100 | units.yr,
                  end_time=5 | units.Myr, number_of_hydro_workers=1, number_of_grav_workers=1,
                  steps_of_inclination=18,
-                 disk_powerlaw=1, filename="BinaryBlackHoleWithAGN"):
+                 disk_powerlaw=1, disk_field_refresh_steps=0, disk_field_time_interpolation=False,
+                 disk_field_radial_cells=32, disk_field_azimuthal_cells=32, disk_field_vertical_cells=8,
+                 gas_drag=False, dry_run=False, dry_run_steps=5, density_map_points=0,
+                 density_map_z_plane=None, filename="BinaryBlackHoleWithAGN"):
         self.smbh = SuperMassiveBlackHole(mass=mass_of_central_black_hole)
         self.smbh_as_potential = smbh_as_potential
         if self.smbh_as_potential:
@@ -75,6 +120,19 @@ class BinaryBlackHolesWithAGN(object):
         self.binaries = Particles()
         self.merged_blackholes = Particles()
         self.binaries_affect_disk = binaries_affect_disk
+        # The gridded disk field replaces the direct disk field wherever the disk kicks the gravity particles,
+        # which is not the case with the SMBH as a potential unless the binaries affect the disk
+        self.disk_field = None
+        if disk_field_refresh_steps > 0:
+            if self.number_of_gas_particles == 0 or (self.smbh_as_potential and not self.binaries_affect_disk):
+                raise ValueError("disk_field_refresh_steps needs gas that kicks the gravity particles, so without "
+                                 "smbh_as_potential or with binaries_affect_disk")
+            self.disk_field = CachedDiskField(self.hydro_code, bridge_timestep=timestep,
+                                              refresh_steps=disk_field_refresh_steps,
+                                              number_of_radial_cells=disk_field_radial_cells,
+                                              number_of_azimuthal_cells=disk_field_azimuthal_cells,
+                                              number_of_vertical_cells=disk_field_vertical_cells,
+                                              time_interpolation=disk_field_time_interpolation)
         self.number_of_binaries = number_of_binaries
         # Generate the binary locations and masses
         self.all_grav_particles = Particles()
@@ -95,9 +153,33 @@ class BinaryBlackHolesWithAGN(object):
         self.channel_from_grav_to_binaries = self.grav_code.particles.new_channel_to(self.all_grav_particles)
         self.channel_from_binaries_to_grav = self.all_grav_particles.new_channel_to(self.grav_code.particles)
 
+        # Dynamical friction of the gas on the blackholes, added to the bridge as a partner of the gravity code
+        self.gas_drag = None
+        if gas_drag and self.number_of_gas_particles > 0:
+            self.gas_drag = DynamicalFriction(self.disk, self.grav_code.particles, self.binaries)
+
         self.timestep = timestep
         self.bridge = self.create_bridges(timestep)
-        self.evolve_model(self.end_time)
+        self.cost_estimate = None
+        if dry_run:
+            self.cost_estimate = self.estimate_cost(dry_run_steps, density_map_points, density_map_z_plane)
+        else:
+            self.evolve_model(self.end_time)
+
+    def write_snapshot(self, filename):
+        """
+        Appends the current gravity particles, and gas if there is any, to the snapshot files
+        :param filename: Prefix of the snapshot files
+        :return: The snapshot files written to
+        """
+        snapshot_files = [filename + "_Particles_{}_Binaries_{}_Gas_AGN.h5".format(self.number_of_binaries,
+                                                                                   self.number_of_gas_particles)]
+        write_set_to_file(self.all_grav_particles, snapshot_files[0], "amuse")
+        if self.number_of_gas_particles > 0:
+            snapshot_files.append(filename + "_Gas_{}_Binaries_{}_Gas_AGN.h5".format(self.number_of_binaries,
+                                                                                    self.number_of_gas_particles))
+            write_set_to_file(self.disk.gas_particles, snapshot_files[1], "amuse")
+        return snapshot_files
 
     def evolve_model(self, end_time):
 
@@ -106,15 +188,7 @@ class BinaryBlackHolesWithAGN(object):
         while sim_time < end_time:
             # Now extract information such as inclination to each other and the disk
             # Now extract information
-            write_set_to_file(self.all_grav_particles,
-                              self.filename + "_Particles_{}_Binaries_{}_Gas_AGN.h5".format(self.number_of_binaries,
-                                                                                            self.number_of_gas_particles),
-                              "amuse")
-            if self.number_of_gas_particles > 0:
-                write_set_to_file(self.disk.gas_particles,
-                                  self.filename + "_Gas_{}_Binaries_{}_Gas_AGN.h5".format(self.number_of_binaries,
-                                                                                          self.number_of_gas_particles),
-                                  "amuse")
+            self.write_snapshot(self.filename)
             # Now evolve the total model of hydro and gravity
             sim_time += self.timestep
             self.bridge.evolve_model(sim_time)
@@ -139,6 +213,138 @@ class BinaryBlackHolesWithAGN(object):
         if self.number_of_gas_particles > 0:
             self.disk.hydro_code.stop()
 
+    def estimate_cost(self, number_of_steps=5, density_map_points=0, density_map_z_plane=None):
+        """
+        Runs a few bridge steps from the initial conditions and extrapolates their cost to the end time, instead
+        of running the simulation
+
+        Each step, the gravity and hydro codes are first evolved on their own to time their drifts, after which the
+        bridge only has the kicks left to do. As the bridge drifts the codes in parallel threads, their sum is an upper
+        bound on the time per step. The first step is a warm up and is not timed, unless it is the only
+        one. Snapshots are written to a temporary directory, which is removed afterwards.
+
+        Refreshes of a cached disk field only happen every refresh_steps steps, so they are timed on their own and
+        added once per refresh over the run. If no refresh other than the first, which also lays out the grid, falls
+        in the steps that are run, one more is timed at the end.
+
+        Peak memory is sampled every step while the codes are running. It only covers this process and the
+        processes it started, MPI workers spawned outside that tree (e.g. by OpenMPI or hydra) are missed, so it is
+        a lower bound.
+
+        :param number_of_steps: Number of bridge steps to run, at least 1
+        :param density_map_points: num_points of a get_density_map call to add to the memory, 0 for none
+        :param density_map_z_plane: z_plane of that get_density_map call
+        :return: Dictionary of the measured costs and the extrapolated totals
+        """
+        snapshot_directory = tempfile.mkdtemp()
+        timings = {'huayno': [], 'gadget2': [], 'bridge': [], 'snapshot': []}
+        snapshot_bytes = []
+        measured_peak_memory = 0
+        later_refresh_seconds = []
+
+        sim_time = 0. | self.end_time.unit
+        try:
+            if number_of_steps < 1:
+                raise ValueError("A dry run needs at least 1 step, got {}".format(number_of_steps))
+            # Dividing two times gives a plain float, not a quantity
+            total_steps = int(numpy.ceil(self.end_time / self.timestep))
+
+            for step in range(number_of_steps):
+                start = default_timer()
+                snapshot_files = self.write_snapshot(os.path.join(snapshot_directory, "dry_run"))
+                snapshot_time = default_timer() - start
+                # The snapshot files are appended to, so their growth is what each step adds to the disk
+                snapshot_bytes.append(sum(os.path.getsize(snapshot_file) for snapshot_file in snapshot_files))
+
+                sim_time += self.timestep
+                start = default_timer()
+                self.grav_code.evolve_model(sim_time)
+                huayno_time = default_timer() - start
+                gadget2_time = 0.
+                if self.number_of_gas_particles > 0:
+                    start = default_timer()
+                    self.hydro_code.evolve_model(sim_time)
+                    gadget2_time = default_timer() - start
+                refreshes_before = len(self.disk_field.refresh_seconds) if self.disk_field is not None else 0
+                start = default_timer()
+                self.bridge.evolve_model(sim_time)
+                bridge_time = default_timer() - start
+                if self.disk_field is not None:
+                    bridge_time -= sum(self.disk_field.refresh_seconds[refreshes_before:])
+
+                self.channel_from_grav_to_binaries.copy()
+                if self.number_of_gas_particles > 0:
+                    self.disk.hydro_channel_to_particles.copy()
+                # Sampled while the workers of the codes are still running
+                measured_peak_memory = max(measured_peak_memory, get_peak_memory_bytes())
+
+                if step > 0 or number_of_steps == 1:
+                    timings['huayno'].append(huayno_time)
+                    timings['gadget2'].append(gadget2_time)
+                    timings['bridge'].append(bridge_time)
+                    timings['snapshot'].append(snapshot_time)
+
+            if self.disk_field is not None:
+                later_refresh_seconds = self.disk_field.refresh_seconds[1:]
+                if not later_refresh_seconds:
+                    particles = self.grav_code.particles
+                    later_refresh_seconds = [self.disk_field.time_refresh(particles.x, particles.y, particles.z)]
+        finally:
+            shutil.rmtree(snapshot_directory, ignore_errors=True)
+            self.grav_code.stop()
+            if self.number_of_gas_particles > 0:
+                self.disk.hydro_code.stop()
+
+        if len(snapshot_bytes) > 1:
+            snapshot_bytes_per_step = (snapshot_bytes[-1] - snapshot_bytes[0]) / (len(snapshot_bytes) - 1.)
+        else:
+            snapshot_bytes_per_step = float(snapshot_bytes[0])
+        seconds_per_step = dict((code, float(numpy.mean(code_timings))) for code, code_timings in timings.items())
+        total_seconds_per_step = sum(seconds_per_step.values())
+
+        number_of_refreshes = 0
+        first_refresh_seconds = 0.
+        seconds_per_refresh = 0.
+        if self.disk_field is not None:
+            # Refreshes at the start and then every refresh_steps steps, up to and including the end time
+            number_of_refreshes = 1 + total_steps // self.disk_field.refresh_steps
+            first_refresh_seconds = self.disk_field.refresh_seconds[0]
+            seconds_per_refresh = float(numpy.mean(later_refresh_seconds))
+        total_refresh_seconds = first_refresh_seconds + (number_of_refreshes - 1) * seconds_per_refresh
+        estimated_wall_time = total_seconds_per_step * total_steps + total_refresh_seconds
+
+        density_map_bytes = 0
+        if density_map_points > 0 and self.number_of_gas_particles > 0:
+            density_map_bytes = self.disk.get_density_map_bytes(density_map_points, density_map_z_plane)
+
+        return {
+            'number_of_binaries': self.number_of_binaries,
+            'number_of_gas_particles': self.number_of_gas_particles,
+            'end_time_yr': self.end_time.value_in(units.yr),
+            'bridge_timestep_yr': self.timestep.value_in(units.yr),
+            'calibration_steps': number_of_steps,
+            'total_steps': total_steps,
+            'huayno_seconds_per_step': seconds_per_step['huayno'],
+            'gadget2_seconds_per_step': seconds_per_step['gadget2'],
+            'bridge_kick_seconds_per_step': seconds_per_step['bridge'],
+            'snapshot_seconds_per_step': seconds_per_step['snapshot'],
+            'seconds_per_step': total_seconds_per_step,
+            'disk_field_refreshes': number_of_refreshes,
+            'disk_field_first_refresh_seconds': first_refresh_seconds,
+            'disk_field_seconds_per_refresh': seconds_per_refresh,
+            'estimated_wall_time_seconds': estimated_wall_time,
+            'estimated_wall_time_hours': estimated_wall_time / 3600.,
+            'snapshot_bytes_per_step': snapshot_bytes_per_step,
+            'estimated_disk_bytes': snapshot_bytes_per_step * total_steps,
+            'measured_peak_memory_bytes': measured_peak_memory,
+            'density_map_bytes': density_map_bytes,
+            'estimated_peak_memory_bytes': measured_peak_memory + density_map_bytes,
+            'peak_memory_is_lower_bound': True,
+            'peak_memory_note': 'Sum of the peak resident memory of this process and its descendants. MPI workers '
+                                'not spawned as descendants (e.g. by OpenMPI or hydra) are not counted, and it is 0 '
+                                'without /proc. density_map_bytes only covers this process, not the Gadget2 workers.',
+        }
+
     def generate_binaries(self):
         """
         Generate a number of blackhole binaries with random initial outer semi major axis and inclination within the boundaries
@@ -173,22 +379,31 @@ class BinaryBlackHolesWithAGN(object):
         If a potential is used for the SMBH:
             Bridge between SMBH potential and disk one way (smbh affects disk)
             Bridge between SMBH potential and binaries one way (smbh affects binaries)
-            Bridge between disk and binaries one way (disk affects binaries)
+            Bridge between binaries and disk one way (binaries affect disk)
+            If binaries_affect_disk, also the other way (disk affects binaries)
         Else:
             Bridge between gravity particles and disk both ways (disk and blackholes affect each other
+
+        If the disk field is cached, the cached field kicks the gravity particles instead of the hydro code.
+        If gas drag is on, the dynamical friction of the disk is added to the partners of the gravity code
         :return:
         """
+        drag = (self.gas_drag,) if self.gas_drag is not None else ()
+        if self.number_of_gas_particles > 0:
+            disk = self.disk_field if self.disk_field is not None else self.hydro_code
         if self.number_of_gas_particles > 0 or self.smbh_as_potential:
             self.bridge = Bridge(use_threading=True, verbose=True)
             self.bridge.timestep = timestep
             if self.smbh_as_potential:
-                self.bridge.add_system(self.grav_code, (self.smbh_potential,))
+                # The gravity code is added once, with all its partners, so no kick is applied twice
+                if self.number_of_gas_particles > 0 and self.binaries_affect_disk:
+                    self.bridge.add_system(self.grav_code, (self.smbh_potential, disk,) + drag)
+                else:
+                    self.bridge.add_system(self.grav_code, (self.smbh_potential,) + drag)
                 if self.number_of_gas_particles > 0:
                     self.bridge.add_system(self.hydro_code, (self.grav_code, self.smbh_potential,))
-                    if self.binaries_affect_disk:
-                        self.bridge.add_system(self.grav_code, (self.hydro_code,))
             else:
-                self.bridge.add_system(self.grav_code, (self.hydro_code,))
+                self.bridge.add_system(self.grav_code, (disk,) + drag)
                 self.bridge.add_system(self.hydro_code, (self.grav_code, ))
         else:
             self.bridge = self.grav_code
@@ -0,0 +1,264 @@
+from __future__ import division, print_function
+from timeit import default_timer
+import numpy
+from amuse.units import units, constants
+from amuse.couple.bridge import CalculateFieldForParticles
+
+
+class CachedDiskField(object):
+    """
+    Gridded, time-reused gravity field of the accretion disk, to be used as the partner of the binaries in the bridge
+
+    Every refresh_steps bridge steps the gas is deposited on a cylindrical (R, phi, z / R) grid, logarithmic in R,
+    and the acceleration at the cell centres is solved for once. In between refreshes, the field at the binaries is found by interpolating
+    the latest cached grid.
+
+    With time_interpolation the field is instead interpolated linearly in time between the last two cached fields,
+    evaluated one refresh interval in the past, so the weight stays between 0 and 1. This avoids extrapolating noisy
+    deposited fields forward and jumps at each refresh, at the cost of a field that lags the gas by one refresh
+    interval. Refresh steps use the same lagged field as all other steps.
+
+    The Green's function takes (N_R * N_z)^2 * (N_phi / 2 + 1) * 48 bytes, about 50 MB for the default 32 x 32 x 8
+    cells, so the vertical cells are kept few by making them uniform in z / R, which follows the flaring disk.
+
+    The grid is laid out from the gas at the first refresh and then kept fixed, so the Green's function only has to
+    be computed once. Gas that has moved outside the grid is deposited in the edge cells, and points outside the
+    grid are given the direct field of the gas particles.
+    """
+
+    def __init__(self, hydro_code, bridge_timestep, refresh_steps=10, number_of_radial_cells=32,
+                 number_of_azimuthal_cells=32, number_of_vertical_cells=8, time_interpolation=False, verbose=True):
+        self.hydro_code = hydro_code
+        self.refresh_interval = refresh_steps * bridge_timestep
+        self.refresh_steps = refresh_steps
+        self.number_of_radial_cells = number_of_radial_cells
+        self.number_of_azimuthal_cells = number_of_azimuthal_cells
+        self.number_of_vertical_cells = number_of_vertical_cells
+        self.time_interpolation = time_interpolation
+        self.verbose = verbose
+        self.gravitational_constant = constants.G.value_in(units.m ** 3 / (units.kg * units.s ** 2))
+
+        self.radial_edges = None
+        self.vertical_edges = None
+        self.green_function = None
+        # (time in s, acceleration grid) of the last two refreshes
+        self.cached_fields = []
+        # (time, maximum and median relative error of the new grid, maximum and median relative error of the field
+        # used up to this refresh) against the direct field at every refresh. The latter two are None at the first
+        self.refresh_errors = []
+        # Wall clock seconds spent in every refresh, the first one includes laying out the grid
+        self.refresh_seconds = []
+
+    def get_gravity_at_point(self, eps, x, y, z):
+        time = self.hydro_code.model_time
+        if self.needs_refresh(time):
+            start = default_timer()
+            self.refresh(time, x, y, z)
+            self.refresh_seconds.append(default_timer() - start)
+
+        x, y, z = x.value_in(units.m), y.value_in(units.m), z.value_in(units.m)
+        inside = self.inside_grid(x, y, z)
+        ax, ay, az = numpy.zeros_like(x), numpy.zeros_like(x), numpy.zeros_like(x)
+        ax[inside], ay[inside], az[inside] = self.interpolate(time.value_in(units.s), x[inside], y[inside], z[inside])
+        if not inside.all():
+            outside = ~inside
+            direct_ax, direct_ay, direct_az = self.get_direct_gravity_at_point(x[outside] | units.m,
+                                                                               y[outside] | units.m,
+                                                                               z[outside] | units.m)
+            ax[outside] = direct_ax.value_in(units.m / units.s ** 2)
+            ay[outside] = direct_ay.value_in(units.m / units.s ** 2)
+            az[outside] = direct_az.value_in(units.m / units.s ** 2)
+
+        return ax | units.m / units.s ** 2, ay | units.m / units.s ** 2, az | units.m / units.s ** 2
+
+    def get_potential_at_point(self, eps, x, y, z):
+        return self.hydro_code.get_potential_at_point(eps, x, y, z)
+
+    def get_direct_gravity_at_point(self, x, y, z):
+        field_code = CalculateFieldForParticles(particles=self.hydro_code.gas_particles)
+        return field_code.get_gravity_at_point(0 * x, x, y, z)
+
+    def needs_refresh(self, time):
+        if not self.cached_fields:
+            return True
+        last_refresh_time = self.cached_fields[-1][0] | units.s
+        # Small tolerance so round off in the bridge time does not skip a refresh
+        return time - last_refresh_time >= (1 - 1e-6) * self.refresh_interval
+
+    def refresh(self, time, x, y, z):
+        """
+        Deposits the gas on the grid, solves for its field and reports the error against the direct field at the
+        points asked for, both of the new grid (discretisation) and of the cached field that would have been used
+        now without the refresh (discretisation, reuse over refresh_steps and the lag of time_interpolation)
+        :param time: Model time of the hydro code
+        """
+        direct_ax, direct_ay, direct_az = self.get_direct_gravity_at_point(x, y, z)
+        x, y, z = x.value_in(units.m), y.value_in(units.m), z.value_in(units.m)
+
+        field = self.solve_gas_field()
+        inside = self.inside_grid(x, y, z)
+        direct = numpy.array([direct_ax.value_in(units.m / units.s ** 2)[inside],
+                              direct_ay.value_in(units.m / units.s ** 2)[inside],
+                              direct_az.value_in(units.m / units.s ** 2)[inside]])
+
+        stale_error = None
+        if self.cached_fields and inside.any():
+            stale = self.interpolate(time.value_in(units.s), x[inside], y[inside], z[inside])
+            stale_error = self.get_relative_error(stale, direct)
+
+        self.cached_fields = (self.cached_fields + [(time.value_in(units.s), field)])[-2:]
+
+        if inside.any():
+            grid_error = self.get_relative_error(self.interpolate_field(field, x[inside], y[inside], z[inside]),
+                                                 direct)
+            self.refresh_errors.append((time, grid_error.max(), numpy.median(grid_error),
+                                        None if stale_error is None else stale_error.max(),
+                                        None if stale_error is None else numpy.median(stale_error)))
+            if self.verbose:
+                message = 'Disk field refreshed at {} yr: grid max relative error {:.3e}, median {:.3e}'.format(
+                    time.value_in(units.yr), grid_error.max(), numpy.median(grid_error))
+                if stale_error is not None:
+                    message += '; reused field max relative error {:.3e}, median {:.3e}'.format(
+                        stale_error.max(), numpy.median(stale_error))
+                print(message)
+
+    def solve_gas_field(self):
+        """
+        Gets the gas from the hydro code, lays out the grid if there is none yet, and solves for the field of the gas
+        :return: Acceleration at the cell centres, see solve_field
+        """
+        gas = self.hydro_code.gas_particles
+        gas_x, gas_y, gas_z = gas.x.value_in(units.m), gas.y.value_in(units.m), gas.z.value_in(units.m)
+        if self.green_function is None:
+            self.make_grid(gas_x, gas_y, gas_z)
+        return self.solve_field(gas_x, gas_y, gas_z, gas.mass.value_in(units.kg))
+
+    def time_refresh(self, x, y, z):
+        """
+        Times the work of a refresh at x, y, z, without changing the cached fields or the error report
+        :return: Wall clock seconds
+        """
+        start = default_timer()
+        self.get_direct_gravity_at_point(x, y, z)
+        self.solve_gas_field()
+        return default_timer() - start
+
+    def get_relative_error(self, approximate, direct):
+        approximate = numpy.array(approximate)
+        return numpy.sqrt(((approximate - direct) ** 2).sum(axis=0) / (direct ** 2).sum(axis=0))
+
+    def make_grid(self, gas_x, gas_y, gas_z):
+        """
+        Lays out the grid around the gas, logarithmic in R and uniform in z / R, so the vertical cells flare with
+        the disk, and computes the Fourier transform over phi of the Green's function between all cell centres
+        """
+        radius = numpy.sqrt(gas_x ** 2 + gas_y ** 2)
+        maximum_radius = 1.01 * radius.max()
+        minimum_radius = min(0.99 * radius[radius > 0].min(), 1e-3 * maximum_radius)
+        maximum_slope = 1.01 * numpy.abs(gas_z[radius > 0] / radius[radius > 0]).max()
+        if maximum_slope == 0:
+            maximum_slope = 1e-3
+
+        self.radial_edges = numpy.logspace(numpy.log10(minimum_radius), numpy.log10(maximum_radius),
+                                           self.number_of_radial_cells + 1)
+        self.vertical_edges = numpy.linspace(-maximum_slope, maximum_slope, self.number_of_vertical_cells + 1)
+        self.log_radial_spacing = numpy.log(self.radial_edges[1] / self.radial_edges[0])
+        self.vertical_spacing = self.vertical_edges[1] - self.vertical_edges[0]
+        self.azimuthal_spacing = 2 * numpy.pi / self.number_of_azimuthal_cells
+
+        radial_centres = numpy.sqrt(self.radial_edges[:-1] * self.radial_edges[1:])
+        heights = radial_centres[:, None] * 0.5 * (self.vertical_edges[:-1] + self.vertical_edges[1:])[None, :]
+
+        # Targets at phi = 0, sources at -d * dphi, so the sum over phi becomes a circular convolution
+        target_radius = radial_centres[:, None, None, None, None]
+        target_height = heights[:, :, None, None, None]
+        source_radius = radial_centres[None, None, :, None, None]
+        source_height = heights[None, None, :, :, None]
+        offset = -numpy.arange(self.number_of_azimuthal_cells) * self.azimuthal_spacing
+        # Soften with half the size of the source cell in R and z
+        radial_width = self.radial_edges[1:] - self.radial_edges[:-1]
+        vertical_width = radial_centres * self.vertical_spacing
+        softening = 0.5 * numpy.sqrt(radial_width ** 2 + vertical_width ** 2)[None, None, :, None, None]
+
+        delta_radial = source_radius * numpy.cos(offset) - target_radius
+        delta_azimuthal = source_radius * numpy.sin(offset)
+        delta_vertical = source_height - target_height
+        inverse_cube = self.gravitational_constant * (delta_radial ** 2 + delta_azimuthal ** 2 +
+                                                      delta_vertical ** 2 + softening ** 2) ** -1.5
+
+        self.green_function = [numpy.fft.rfft(delta * inverse_cube, axis=-1)
+                               for delta in (delta_radial, delta_azimuthal, delta_vertical)]
+
+    def solve_field(self, gas_x, gas_y, gas_z, gas_mass):
+        """
+        Deposits the gas on the grid and convolves it with the Green's function
+        :return: Acceleration at the cell centres, as an array of (a_R, a_phi, a_z) with shape (3, N_R, N_z, N_phi)
+        """
+        radius = numpy.clip(numpy.sqrt(gas_x ** 2 + gas_y ** 2), self.radial_edges[0], self.radial_edges[-1])
+        azimuth = numpy.mod(numpy.arctan2(gas_y, gas_x), 2 * numpy.pi)
+        slope = numpy.clip(gas_z / radius, self.vertical_edges[0], self.vertical_edges[-1])
+        mass, _ = numpy.histogramdd((radius, slope, azimuth),
+                                    bins=(self.radial_edges, self.vertical_edges,
+                                          numpy.linspace(0, 2 * numpy.pi, self.number_of_azimuthal_cells + 1)),
+                                    weights=gas_mass)
+
+        transformed_mass = numpy.fft.rfft(mass, axis=-1)
+        return numpy.array([numpy.fft.irfft(numpy.einsum('abk,ijabk->ijk', transformed_mass, green_function),
+                                            n=self.number_of_azimuthal_cells, axis=-1)
+                            for green_function in self.green_function])
+
+    def inside_grid(self, x, y, z):
+        radius = numpy.sqrt(x ** 2 + y ** 2)
+        return ((radius >= self.radial_edges[0]) & (radius <= self.radial_edges[-1]) &
+                (numpy.abs(z) <= self.vertical_edges[-1] * radius))
+
+    def interpolate(self, time, x, y, z):
+        """
+        Interpolates the cached field. If time_interpolation is set, it is interpolated linearly in time between
+        the last two refreshes at one refresh interval before the given time
+        """
+        latest_time, latest_field = self.cached_fields[-1]
+        latest = numpy.array(self.interpolate_field(latest_field, x, y, z))
+        if not self.time_interpolation or len(self.cached_fields) < 2:
+            return latest
+
+        previous_time, previous_field = self.cached_fields[0]
+        previous = numpy.array(self.interpolate_field(previous_field, x, y, z))
+        lagged_time = time - self.refresh_interval.value_in(units.s)
+        weight = numpy.clip((lagged_time - previous_time) / (latest_time - previous_time), 0., 1.)
+        return (1 - weight) * previous + weight * latest
+
+    def interpolate_field(self, field, x, y, z):
+        """
+        Trilinear interpolation of the field between cell centres, in log R, phi and z / R
+        :return: Cartesian acceleration components at the points
+        """
+        radius = numpy.sqrt(x ** 2 + y ** 2)
+        azimuth = numpy.mod(numpy.arctan2(y, x), 2 * numpy.pi)
+
+        radial_index, radial_weight = self.cell_and_weight(
+            numpy.log(radius / self.radial_edges[0]) / self.log_radial_spacing - 0.5, self.number_of_radial_cells)
+        vertical_index, vertical_weight = self.cell_and_weight(
+            (z / radius - self.vertical_edges[0]) / self.vertical_spacing - 0.5, self.number_of_vertical_cells)
+        azimuthal_position = azimuth / self.azimuthal_spacing - 0.5
+        azimuthal_index = numpy.floor(azimuthal_position).astype(int)
+        azimuthal_weight = azimuthal_position - azimuthal_index
+
+        acceleration = numpy.zeros((3, len(radius)))
+        for i, w_r in ((radial_index, 1 - radial_weight), (radial_index + 1, radial_weight)):
+            for j, w_z in ((vertical_index, 1 - vertical_weight), (vertical_index + 1, vertical_weight)):
+                for k, w_phi in ((azimuthal_index, 1 - azimuthal_weight), (azimuthal_index + 1, azimuthal_weight)):
+                    acceleration += w_r * w_z * w_phi * field[:, i, j, numpy.mod(k, self.number_of_azimuthal_cells)]
+
+        radial, azimuthal, vertical = acceleration
+        cos_phi, sin_phi = numpy.cos(azimuth), numpy.sin(azimuth)
+        return radial * cos_phi - azimuthal * sin_phi, radial * sin_phi + azimuthal * cos_phi, vertical
+
+    def cell_and_weight(self, position, number_of_cells):
+        """
+        Lower cell centre index and interpolation weight along a non periodic axis, held constant past the outer
+        cell centres
+        """
+        index = numpy.clip(numpy.floor(position).astype(int), 0, number_of_cells - 2)
+        weight = numpy.clip(position - index, 0., 1.)
+        return index, weight
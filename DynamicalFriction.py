@@ -0,0 +1,113 @@
+from __future__ import division, print_function
+import numpy
+from scipy.spatial import cKDTree
+from amuse.units import units, constants
+
+
+class DynamicalFriction(object):
+    """
+    Gaseous dynamical friction of the disk on the blackholes in the binaries, to be used as a partner of the gravity
+    code in the bridge
+
+    Once per bridge step a KD-tree is built over the gas particles of the accretion disk, and the density, sound speed
+    and mean velocity of the nearest gas particles around every blackhole are found in a single query. The drag is
+    the one of Ostriker (1999) for a body moving through a uniform gaseous medium, which reduces to the Chandrasekhar
+    form in the supersonic limit.
+
+    Only the blackholes in the binaries feel the drag, other particles in the gravity code (the SMBH) get no kick.
+    """
+
+    def __init__(self, disk, particles, binaries, number_of_neighbours=32, coulomb_logarithm=3.0, gamma=5. / 3.):
+        """
+        :param disk: AccretionDisk whose gas_particles are sampled
+        :param particles: Particles of the gravity code, in the order the bridge asks for their kicks
+        :param binaries: Particle set of the blackholes in the binaries
+        :param number_of_neighbours: Number of gas particles used to sample the gas around each blackhole
+        :param coulomb_logarithm: ln(Lambda) for the supersonic drag
+        :param gamma: Adiabatic index of the gas, to get the sound speed from the internal energy
+        """
+        self.disk = disk
+        self.particles = particles
+        self.binaries = binaries
+        self.number_of_neighbours = number_of_neighbours
+        self.coulomb_logarithm = coulomb_logarithm
+        self.gamma = gamma
+        self.gravitational_constant = constants.G.value_in(units.m ** 3 / (units.kg * units.s ** 2))
+
+        self.tree = None
+        self.tree_time = None
+
+    def get_gravity_at_point(self, eps, x, y, z):
+        self.update_tree()
+
+        ax, ay, az = numpy.zeros(len(x)), numpy.zeros(len(x)), numpy.zeros(len(x))
+        feels_drag = numpy.in1d(self.particles.key, self.binaries.key)
+        if feels_drag.any():
+            position = numpy.array([x.value_in(units.m), y.value_in(units.m), z.value_in(units.m)]).T[feels_drag]
+            velocity = self.particles.velocity.value_in(units.m / units.s)[feels_drag]
+            mass = self.particles.mass.value_in(units.kg)[feels_drag]
+            ax[feels_drag], ay[feels_drag], az[feels_drag] = self.get_drag(position, velocity, mass)
+
+        return ax | units.m / units.s ** 2, ay | units.m / units.s ** 2, az | units.m / units.s ** 2
+
+    def get_potential_at_point(self, eps, x, y, z):
+        # The drag is not conservative, it adds nothing to the potential
+        return numpy.zeros(len(x)) | units.m ** 2 / units.s ** 2
+
+    def update_tree(self):
+        """
+        Copies the gas from the hydro code and rebuilds the tree, once for every new hydro model time
+        """
+        time = self.disk.hydro_code.model_time
+        if self.tree is not None and time == self.tree_time:
+            return
+
+        self.disk.hydro_channel_to_particles.copy()
+        gas = self.disk.gas_particles
+        self.tree = cKDTree(gas.position.value_in(units.m))
+        self.gas_mass = gas.mass.value_in(units.kg)
+        self.gas_velocity = gas.velocity.value_in(units.m / units.s)
+        self.gas_sound_speed = numpy.sqrt(self.gamma * (self.gamma - 1) * gas.u.value_in(units.m ** 2 / units.s ** 2))
+        self.tree_time = time
+
+    def get_local_gas(self, position):
+        """
+        Samples the gas around all positions at once. The sphere reaching out to the k-th nearest gas particle
+        holds the k - 1 particles inside it, so the k-th one only sets the radius
+        :return: Density, sound speed and mass weighted velocity of the gas around each position
+        """
+        number_of_neighbours = max(min(self.number_of_neighbours, len(self.gas_mass)), 2)
+        distance, neighbours = self.tree.query(position, k=number_of_neighbours)
+        distance = distance.reshape(len(position), number_of_neighbours)
+        neighbours = neighbours.reshape(len(position), number_of_neighbours)[:, :-1]
+
+        mass = self.gas_mass[neighbours]
+        total_mass = mass.sum(axis=1)
+        density = total_mass / (4. / 3. * numpy.pi * distance[:, -1] ** 3)
+        sound_speed = (mass * self.gas_sound_speed[neighbours]).sum(axis=1) / total_mass
+        velocity = (mass[:, :, None] * self.gas_velocity[neighbours]).sum(axis=1) / total_mass[:, None]
+        return density, sound_speed, velocity
+
+    def get_drag(self, position, velocity, mass):
+        """
+        Ostriker (1999) drag on bodies of the given mass moving through the local gas
+        :return: Acceleration components, in m/s^2
+        """
+        density, sound_speed, gas_velocity = self.get_local_gas(position)
+        relative_velocity = velocity - gas_velocity
+        speed = numpy.sqrt((relative_velocity ** 2).sum(axis=1))
+        mach = speed / sound_speed
+
+        # Keep away from the logarithmic divergence at Mach 1
+        subsonic_mach = numpy.minimum(mach, 1 - 1e-3)
+        supersonic_mach = numpy.maximum(mach, 1 + 1e-3)
+        subsonic = 0.5 * numpy.log((1 + subsonic_mach) / (1 - subsonic_mach)) - subsonic_mach
+        supersonic = 0.5 * numpy.log(1 - 1 / supersonic_mach ** 2) + self.coulomb_logarithm
+        drag_integral = numpy.maximum(numpy.where(mach < 1, subsonic, supersonic), 0.)
+
+        # a = -4 pi G^2 M rho I / V^2 along V, with I / V^3 -> 1 / (3 c_s^3) for slow bodies
+        slow = mach < 1e-3
+        integral_over_speed_cubed = numpy.where(slow, 1 / (3 * sound_speed ** 3),
+                                                drag_integral / numpy.where(slow, 1., speed) ** 3)
+        drag = -4 * numpy.pi * self.gravitational_constant ** 2 * mass * density * integral_over_speed_cubed
+        return (drag[:, None] * relative_velocity).T
@@ -1,3 +1,5 @@
+from __future__ import print_function
+import json
 from amuse.units import units
 from BinaryBlackHolesWithAGN import BinaryBlackHolesWithAGN
 from amuse.units.optparse import OptionParser
@@ -30,6 +32,34 @@ def new_option_parser():
                       help="Number of workers for hydro code [%default]")
     result.add_option("--number_of_grav_workers", dest="number_of_grav_workers", type="int", default=12,
                       help="Number of workers for gravity code [%default]")
+    result.add_option("--disk_field_refresh_steps", dest="disk_field_refresh_steps", type="int", default=0,
+                      help="Bridge steps between refreshes of a gridded disk field that replaces the direct disk field on "
+                           "the gravity particles, 0 for the direct field. Needs gas, and binaries_affect_disk if "
+                           "smbh_as_potential [%default]")
+    result.add_option("--disk_field_time_interpolation", dest="disk_field_time_interpolation", action="store_true",
+                      default=False,
+                      help="Whether to interpolate linearly in time between the last two gridded disk fields. This "
+                           "smooths the jumps at refreshes, but lags the field by one refresh interval [%default]")
+    result.add_option("--disk_field_radial_cells", dest="disk_field_radial_cells", type="int", default=32,
+                      help="No. of logarithmic radial cells of the gridded disk field [%default]")
+    result.add_option("--disk_field_azimuthal_cells", dest="disk_field_azimuthal_cells", type="int", default=32,
+                      help="No. of azimuthal cells of the gridded disk field [%default]")
+    result.add_option("--disk_field_vertical_cells", dest="disk_field_vertical_cells", type="int", default=8,
+                      help="No. of vertical cells of the gridded disk field, uniform in z / R. Memory grows as "
+                           "(radial * vertical)^2 * azimuthal cells [%default]")
+    result.add_option("--gas_drag", dest="gas_drag", action="store_true", default=False,
+                      help="Whether to add dynamical friction of the gas on the blackholes to the bridge [%default]")
+    result.add_option("--dry_run", dest="dry_run", action="store_true", default=False,
+                      help="Whether to only estimate the wall time, memory and disk usage of the run, printed as JSON "
+                           "on the last line [%default]")
+    result.add_option("--dry_run_steps", dest="dry_run_steps", type="int", default=5,
+                      help="No. of bridge steps to calibrate the dry run estimate on [%default]")
+    result.add_option("--density_map_points", dest="density_map_points", type="int", default=0,
+                      help="num_points of a get_density_map call to include in the dry run memory estimate, 0 for "
+                           "none [%default]")
+    result.add_option("--density_map_z_plane", dest="density_map_z_plane", type="float", default=None,
+                      help="z_plane in AU of that get_density_map call, a 2D map, or a 3D one if not given "
+                           "[%default]")
     result.add_option("--filename", dest="filename", type="string", default="BinaryBlackHoles",
                       help="Filename [%default]")
 
@@ -48,20 +78,44 @@ def main(mass_of_central_black_hole,
          disk_mass_fraction,
          number_of_hydro_workers,
          number_of_grav_workers,
+         disk_field_refresh_steps,
+         disk_field_time_interpolation,
+         disk_field_radial_cells,
+         disk_field_azimuthal_cells,
+         disk_field_vertical_cells,
+         gas_drag,
+         dry_run,
+         dry_run_steps,
+         density_map_points,
+         density_map_z_plane,
          filename):
-    BinaryBlackHolesWithAGN(mass_of_central_black_hole=mass_of_central_black_hole,
-                            number_of_binaries=number_of_binaries,
-                            number_of_gas_particles=number_of_gas_particles,
-                            disk_mass_fraction=disk_mass_fraction,
-                            binaries_affect_disk=binaries_affect_disk,
-                            smbh_as_potential=smbh_as_potential,
-                            blackhole_masses=blackhole_mass,
-                            timestep=bridge_timestep,
-                            gravity_timestep=gravity_timestep,
-                            end_time=end_time,
-                            number_of_hydro_workers=number_of_hydro_workers,
-                            number_of_grav_workers=number_of_grav_workers,
-                            filename=filename)
+    if dry_run and dry_run_steps < 1:
+        raise ValueError("--dry_run_steps must be at least 1, got {}".format(dry_run_steps))
+    simulation = BinaryBlackHolesWithAGN(mass_of_central_black_hole=mass_of_central_black_hole,
+                                         number_of_binaries=number_of_binaries,
+                                         number_of_gas_particles=number_of_gas_particles,
+                                         disk_mass_fraction=disk_mass_fraction,
+                                         binaries_affect_disk=binaries_affect_disk,
+                                         smbh_as_potential=smbh_as_potential,
+                                         blackhole_masses=blackhole_mass,
+                                         timestep=bridge_timestep,
+                                         gravity_timestep=gravity_timestep,
+                                         end_time=end_time,
+                                         number_of_hydro_workers=number_of_hydro_workers,
+                                         number_of_grav_workers=number_of_grav_workers,
+                                         disk_field_refresh_steps=disk_field_refresh_steps,
+                                         disk_field_time_interpolation=disk_field_time_interpolation,
+                                         disk_field_radial_cells=disk_field_radial_cells,
+                                         disk_field_azimuthal_cells=disk_field_azimuthal_cells,
+                                         disk_field_vertical_cells=disk_field_vertical_cells,
+                                         gas_drag=gas_drag,
+                                         dry_run=dry_run,
+                                         dry_run_steps=dry_run_steps,
+                                         density_map_points=density_map_points,
+                                         density_map_z_plane=density_map_z_plane,
+                                         filename=filename)
+    if dry_run:
+        print(json.dumps(simulation.cost_estimate, sort_keys=True))
 
 
 if __name__ == "__main__":